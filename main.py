@@ -43,7 +43,7 @@ def print_info():
     print(f"{a_kb:.1f} ({pct:.2f}%)\n")
 
 def printer(msg, ipc):
-    ipc.syscall_send(1, (msg[1], 0, "hello"))
+    ipc.reply(msg[0], msg[1], "hello")
 
 def test_rmach():
     sched = PrioSched()
@@ -5,3 +5,4 @@ PORT_ERR_NO_RIGHT = 3
 PORT_ERR_INVALID_NAME = 4
 PORT_EXTINGUISHED = 5
 HANDLER_ERROR = 6
+PORT_ERR_NO_SPACE = 7
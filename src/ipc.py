@@ -1,5 +1,6 @@
 from collections import deque
 from consts import *
+from mem import *
 
 rights = {}
 
@@ -38,10 +39,14 @@ def check(pid, port_id, required_perm):
     return (rights.get((pid << 16) | port_id, 0) & required_perm) == required_perm
 
 class rMachPort:
-    def __init__(self, own):
+    def __init__(self, own, acct=None):
         self.owner_pid = own
         self.ref_count = 0
         self.messages = deque((), 32)
+        self.sizes = deque((), 32)
+        self.mem = 0
+        self.acct = acct
+        self.budget = acct.queue if acct else 0
         self.blocked = None
 
     def retain(self):
@@ -55,15 +60,23 @@ class rMachPort:
     def put(self, data):
         if len(self.messages) >= 32:
             return self.owner_pid
+
+        size = msize(data)
+        if self.budget and self.messages and self.mem + size > self.budget:
+            return None
         
         if self.blocked:
             self.blocked = False
         
         self.messages.append(data)
+        self.sizes.append(size)
+        self.mem += size
         return self.owner_pid
 
     def read(self):
         if self.messages:
+            size = self.sizes.popleft()
+            self.mem -= size
             return self.messages.popleft(), PORT_SUCCESS
         
         self.blocked = True
@@ -74,12 +87,21 @@ class rMachIPC:
         self.ports = {}
         self.port_counter = 0
         self.py_handlers = {}
+        self.accounts = {}
+        self.sessions = {}
+        self.grantors = {}
+        self.pending = []
+        self.destroy_hooks = []
         self.sched = None
 
     def create_port(self, pid):
+        acct = self.accounts.get(pid)
+        if acct and not acct.charge(PORT_COST + acct.queue):
+            return -1
+
         self.port_counter += 1
         p_id = self.port_counter
-        port = rMachPort(pid)
+        port = rMachPort(pid, acct)
         self.ports[p_id] = port
         add_right(pid, p_id, RECEIVE, port)
         return p_id
@@ -88,6 +110,16 @@ class rMachIPC:
         self.port_counter += 1
         self.py_handlers[self.port_counter] = func
         return self.port_counter
+
+    def rm_py_h(self, h_id):
+        if h_id not in self.py_handlers:
+            return PORT_ERR_INVALID_NAME
+        del self.py_handlers[h_id]
+        for k in [k for k in rights if (k & 0xFFFF) == h_id]:
+            del rights[k]
+        for k in [k for k in self.sessions if (k >> 16) == h_id]:
+            self.close_session(k)
+        return PORT_EXTINGUISHED
         
     def send(self, pid, msg):
         if not len(msg) == 3:
@@ -103,20 +135,26 @@ class rMachIPC:
         
         if not target_port:
             if remote_port in self.py_handlers:
-                if msg[1]:
-                    reply_port_obj = self.ports.get(msg[1])
-                    if reply_port_obj:
-                        add_right(remote_port, msg[1], SERVER, reply_port_obj)
+                if msg[1] and check(pid, msg[1], SEND):
+                    self.open_session(remote_port, msg[1], pid)
                 try:
                     self.py_handlers[remote_port](msg, self)
                 except:
-                    self.syscall_send(remote_port, (msg[1], 0, HANDLER_ERROR))
+                    self.reply(remote_port, msg[1], HANDLER_ERROR)
+                self.flush()
                 return PORT_SUCCESS, None
             return PORT_ERR_INVALID_NAME, None
         
+        blocked = target_port.blocked
         target_pid = target_port.put(msg[2])
+        if target_pid is None:
+            return PORT_ERR_NO_SPACE, None
 
         consume_right(pid, remote_port, target_port, self)
+        self.donate(pid, target_pid, remote_port, msg[1])
+
+        if blocked:
+            self.wake(target_pid)
         
         if msg[1]:
             reply_port_obj = self.ports.get(msg[1], 0)
@@ -133,26 +171,59 @@ class rMachIPC:
         
         remote_port_id = msg[0]
     
-        if not check(py_handler, remote_port_id, SERVER):
-            return PORT_ERR_NO_RIGHT
+        if not (check(py_handler, remote_port_id, SERVER) or \
+            ((py_handler << 16) | remote_port_id) in self.sessions):
+                return PORT_ERR_NO_RIGHT
         
         target_port = self.ports.get(remote_port_id)
         if not target_port:
             return PORT_ERR_INVALID_NAME
         
-        target_port.put(msg[2])
+        blocked = target_port.blocked
+        if target_port.put(msg[2]) is None:
+            return PORT_ERR_NO_SPACE
         consume_right(py_handler, remote_port_id, target_port, self)
 
-        if target_port.blocked:
-            target_port.blocked = False
-            self.sched.wake_up(target_port.owner_pid,
-                               self.getprio(target_port.owner_pid))
+        if blocked:
+            self.wake(target_port.owner_pid)
             
         if msg[1]:
             reply_port_obj = self.ports.get(msg[1], 0)
             self.transfer_right(py_handler, target_port.owner_pid, msg[1])
         
         return PORT_SUCCESS
+
+    def open_session(self, py_handler, port_id, pid):
+        key = (py_handler << 16) | port_id
+        if key not in self.sessions:
+            port = self.ports.get(port_id)
+            if port:
+                self.sessions[key] = port
+                self.grantors[key] = pid
+
+    def close_session(self, key):
+        del self.sessions[key]
+        del self.grantors[key]
+
+    def reply(self, py_handler, port_id, data):
+        port = self.sessions.get((py_handler << 16) | port_id)
+        if port is None:
+            return PORT_ERR_NO_RIGHT
+
+        blocked = port.blocked
+        if port.put(data) is None:
+            return PORT_ERR_NO_SPACE
+
+        if blocked:
+            self.pending.append(port.owner_pid)
+        return PORT_SUCCESS
+
+    def flush(self):
+        if not self.pending:
+            return
+        for pid in self.pending:
+            self.wake(pid)
+        self.pending.clear()
     
     def receive(self, pid, port_id):
         port_obj = self.ports.get(port_id)
@@ -174,6 +245,9 @@ class rMachIPC:
                 add_right(dest_pid, port_id, SEND, self.ports[port_id])
                 
     def cleanup_process(self, pid):
+        for key in [k for k in self.grantors if self.grantors[k] == pid]:
+            self.close_session(key)
+
         for key in [k for k in rights if (k >> 16) == pid]:
             port_id = key & 0xFFFF
             port_obj = self.ports.get(port_id)
@@ -187,9 +261,15 @@ class rMachIPC:
 
     def destroy_port(self, port_id):
         if port_id in self.ports:
-            del self.ports[port_id]
+            port = self.ports.pop(port_id)
+            if port.acct:
+                port.acct.uncharge(PORT_COST + port.budget)
             keys_to_del = [k for k in rights if (k & 0xFFFF) == port_id]
             for k in keys_to_del:
                 del rights[k]
+            for k in [k for k in self.sessions if (k & 0xFFFF) == port_id]:
+                self.close_session(k)
+            for hook in self.destroy_hooks:
+                hook(port_id)
             return PORT_EXTINGUISHED
         return PORT_ERR_INVALID_NAME
@@ -0,0 +1,42 @@
+SLOT = 4
+STACK_COST = 33 * SLOT
+PORT_COST = 64 + 32 * SLOT
+QUEUE_SHIFT = 4
+
+def msize(val):
+    t = type(val)
+    if t is int or t is bool or val is None:
+        return SLOT
+    if t is float:
+        return 16
+    if t is str or t is bytes:
+        return 16 + len(val)
+    if t is list or t is tuple:
+        n = 16 + SLOT * len(val)
+        for v in val:
+            n += msize(v)
+        return n
+    if t is dict:
+        n = 32 + 2 * SLOT * len(val)
+        for k in val:
+            n += msize(k) + msize(val[k])
+        return n
+    return 32
+
+class MemAccount:
+    def __init__(self, quota):
+        self.quota = quota
+        self.queue = quota >> QUEUE_SHIFT
+        self.used = 0
+
+    def fits(self, n):
+        return not self.quota or self.used + n <= self.quota
+
+    def charge(self, n):
+        if not self.fits(n):
+            return False
+        self.used += n
+        return True
+
+    def uncharge(self, n):
+        self.used -= n
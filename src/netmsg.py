@@ -0,0 +1,253 @@
+import errno
+import struct
+from ipc import *
+
+T_NONE, T_BYTE, T_INT, T_LONG, T_FLOAT, T_STR, T_LIST, T_DICT = range(8)
+
+HDR = '<HHH'
+HDR_LEN = 6
+BATCH = 256
+
+def encode(val, out):
+    t = type(val)
+    if val is None:
+        out.append(T_NONE)
+    elif t is int or t is bool:
+        if -128 <= val < 128:
+            out.append(T_BYTE)
+            out.extend(struct.pack('<b', val))
+        elif -0x80000000 <= val < 0x80000000:
+            out.append(T_INT)
+            out.extend(struct.pack('<i', val))
+        else:
+            out.append(T_LONG)
+            out.extend(struct.pack('<q', val))
+    elif t is float:
+        out.append(T_FLOAT)
+        out.extend(struct.pack('<d', val))
+    elif t is str:
+        b = val.encode()
+        out.append(T_STR)
+        out.extend(struct.pack('<H', len(b)))
+        out.extend(b)
+    elif t is list or t is tuple:
+        out.append(T_LIST)
+        out.extend(struct.pack('<H', len(val)))
+        for v in val:
+            encode(v, out)
+    elif t is dict:
+        out.append(T_DICT)
+        out.extend(struct.pack('<H', len(val)))
+        for k in val:
+            encode(k, out)
+            encode(val[k], out)
+    else:
+        raise TypeError(t)
+    return out
+
+def decode(buf, off):
+    tag = buf[off]
+    off += 1
+    if tag == T_NONE:
+        return None, off
+    if tag == T_BYTE:
+        return struct.unpack_from('<b', buf, off)[0], off + 1
+    if tag == T_INT:
+        return struct.unpack_from('<i', buf, off)[0], off + 4
+    if tag == T_LONG:
+        return struct.unpack_from('<q', buf, off)[0], off + 8
+    if tag == T_FLOAT:
+        return struct.unpack_from('<d', buf, off)[0], off + 8
+    n = struct.unpack_from('<H', buf, off)[0]
+    off += 2
+    if tag == T_STR:
+        return bytes(buf[off:off + n]).decode(), off + n
+    if tag == T_LIST:
+        res = []
+        for _ in range(n):
+            v, off = decode(buf, off)
+            res.append(v)
+        return res, off
+    if tag == T_DICT:
+        res = {}
+        for _ in range(n):
+            k, off = decode(buf, off)
+            v, off = decode(buf, off)
+            res[k] = v
+        return res, off
+    raise ValueError(tag)
+
+class NetLink:
+    def __init__(self, stream):
+        self.stream = stream
+        self.tx = bytearray()
+        self.rx = bytearray()
+
+    def queue(self, dest, reply, data):
+        payload = encode(data, bytearray())
+        self.tx.extend(struct.pack(HDR, len(payload), dest, reply))
+        self.tx.extend(payload)
+
+    def flush(self):
+        if not self.tx:
+            return True
+        try:
+            n = self.stream.write(self.tx)
+        except OSError as e:
+            if e.args[0] == errno.EAGAIN:
+                return True
+            self.tx = bytearray()
+            return False
+        if n:
+            self.tx = self.tx[n:]
+        return True
+
+    def frames(self):
+        try:
+            data = self.stream.read(BATCH)
+        except OSError as e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+            data = None
+        if data:
+            self.rx.extend(data)
+
+        rx = self.rx
+        res = []
+        off = 0
+        while len(rx) - off >= HDR_LEN:
+            plen, dest, reply = struct.unpack_from(HDR, rx, off)
+            end = off + HDR_LEN + plen
+            if len(rx) < end:
+                break
+            try:
+                data, pos = decode(rx, off + HDR_LEN)
+                if pos == end:
+                    res.append((dest, reply, data))
+            except:
+                pass
+            off = end
+
+        if off:
+            self.rx = rx[off:]
+        return res
+
+class NetMsgServer:
+    def __init__(self, ipc, connect=None):
+        self.ipc = ipc
+        self.connect = connect
+        self.pool = {}
+        self.proxies = {}
+        self.routes = {}
+        self.exported = set()
+        self.replies = {}
+        self.oneshot = {}
+        self.pid = ipc.mk_py_h(self.pump)
+        ipc.destroy_hooks.append(self.port_destroyed)
+
+    def add_link(self, node, stream):
+        self.pool[node] = NetLink(stream)
+
+    def link(self, node):
+        link = self.pool.get(node)
+        if link is None:
+            link = NetLink(self.connect(node))
+            self.pool[node] = link
+        return link
+
+    def export(self, port_id):
+        self.exported.add(port_id)
+
+    def proxy(self, node, remote_port):
+        key = (node, remote_port)
+        p_id = self.proxies.get(key)
+        if p_id is None:
+            p_id = self.ipc.mk_py_h(self.forward)
+            self.proxies[key] = p_id
+            self.routes[p_id] = key
+        return p_id
+
+    def drop_proxy(self, p_id):
+        del self.proxies[self.routes.pop(p_id)]
+        self.oneshot.pop(p_id, None)
+        self.ipc.rm_py_h(p_id)
+
+    def port_destroyed(self, port_id):
+        self.exported.discard(port_id)
+        for key in [k for k in self.replies if k[1] == port_id]:
+            del self.replies[key]
+        for p_id in [p for p in self.oneshot if self.oneshot[p][1] == port_id]:
+            self.drop_proxy(p_id)
+
+    def forward(self, msg, ipc):
+        node, remote_port = self.routes[msg[0]]
+        reply = msg[1]
+
+        if reply:
+            if ((msg[0] << 16) | reply) in ipc.sessions:
+                key = (node, reply)
+                self.replies[key] = self.replies.get(key, 0) + 1
+            else:
+                reply = 0
+
+        entry = self.oneshot.get(msg[0])
+        if entry:
+            entry[0] -= 1
+            if not entry[0]:
+                self.drop_proxy(msg[0])
+
+        link = self.link(node)
+        link.queue(remote_port, reply, msg[2])
+        if len(link.tx) >= BATCH and not link.flush():
+            del self.pool[node]
+
+    def deliver(self, node, dest, reply, data):
+        if dest not in self.exported:
+            key = (node, dest)
+            pending = self.replies.get(key)
+            if not pending:
+                return PORT_ERR_NO_RIGHT
+            if pending == 1:
+                del self.replies[key]
+            else:
+                self.replies[key] = pending - 1
+
+        port = self.ipc.ports.get(dest)
+        if port is None:
+            self.exported.discard(dest)
+            return PORT_ERR_INVALID_NAME
+
+        if reply:
+            p_id = self.proxies.get((node, reply))
+            if p_id is None or p_id in self.oneshot:
+                p_id = self.proxy(node, reply)
+                entry = self.oneshot.get(p_id)
+                if entry:
+                    entry[0] += 1
+                else:
+                    self.oneshot[p_id] = [1, dest]
+            add_right(port.owner_pid, p_id, SEND, None)
+            reply = p_id
+
+        self.ipc.open_session(self.pid, dest, self.pid)
+        return self.ipc.reply(self.pid, dest, data)
+
+    def poll(self):
+        for node in list(self.pool):
+            link = self.pool[node]
+            try:
+                frames = link.frames() if link.flush() else None
+            except:
+                frames = None
+            if frames is None:
+                del self.pool[node]
+                continue
+
+            for dest, reply, data in frames:
+                try:
+                    self.deliver(node, dest, reply, data)
+                except:
+                    pass
+
+    def pump(self, msg, ipc):
+        self.poll()
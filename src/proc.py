@@ -1,4 +1,5 @@
 from consts import *
+from mem import *
 
 FETCH, STORE, PUSH, POP, ADD, SUB, MUL, DIV, LT, GT, EQ, NOTEQ, JZ, JNZ, JMP, RECV, SEND = range(17)
 LIST, DICT, INDEX, CREATE_PORT, APPEND, RETURN, PRINT, HALT = range(17, 25)
@@ -26,62 +27,111 @@ class Assembler:
             return val[0:8].replace('^', ' ').replace('~', '\n')
         return val.replace('^', ' ').replace('~', '\n')
 
-    def assemble(self, source):
-        raw_lines = [l.strip() for l in source.split('\n') if l.strip() and not l.startswith('#')]
-        expanded_lines = []
-        current_macro_name = None
-        
-        for line in raw_lines:
-            if line.startswith('.func '):
-                current_macro_name = line.split()[1].upper()
-                self.macros[current_macro_name] = []
-                continue
-            if line == '.end':
-                current_macro_name = None
-                continue
-            
-            if current_macro_name:
-                self.macros[current_macro_name].append(line)
-            else:
-                parts = line.split()
-                cmd_potential = parts[0].upper()
-                if cmd_potential in self.macros:
-                    expanded_lines.extend(self.macros[cmd_potential])
-                else:
-                    expanded_lines.append(line)
+    def lines(self, source):
+        if not isinstance(source, str):
+            for line in source:
+                yield line
+            return
 
+        start = 0
+        while True:
+            end = source.find('\n', start)
+            if end < 0:
+                yield source[start:]
+                return
+            yield source[start:end]
+            start = end + 1
+
+    def assemble(self, source):
+        self.macros = {}
+        self.included = set()
+        self.expanding = []
+        bytecode = []
         labels = {}
-        pc = 0
-        final_code_lines = []
-        
-        for line in expanded_lines:
+        fixups = {}
+
+        self.feed(self.lines(source), bytecode, labels, fixups)
+
+        for label in fixups:
+            for pos, arg in fixups[label]:
+                bytecode[pos] = self.atom(arg)
+
+        return bytecode
+
+    def feed(self, lines, bytecode, labels, fixups):
+        body = None
+
+        for line in lines:
             line = line.split('#')[0].strip()
             if not line: continue
-            
-            if line.startswith(':'):
-                labels[line.upper()] = pc
-            else:
-                final_code_lines.append(line)
-                cmd = line.split()[0].upper()
-                if cmd in self.ops:
-                    pc += self.ops[cmd][1]
 
-        bytecode = []
-        for line in final_code_lines:
+            if body is not None:
+                if line == '.end':
+                    body = None
+                else:
+                    body.append(line)
+                continue
+
             parts = line.split()
             cmd = parts[0].upper()
-            
-            op_code, length = self.ops[cmd]
-            bytecode.append(op_code)
-            
-            if length == 2:
-                arg = parts[1] if len(parts) > 1 else 0
-                if isinstance(arg, str) and arg.upper() in labels:
-                    bytecode.append(labels[arg.upper()])
-                else:
-                    bytecode.append(self.atom(arg))
-                    
-        return bytecode
+
+            if cmd == '.FUNC':
+                body = []
+                self.macros[parts[1].upper()] = (parts[2:], body)
+            elif cmd == '.END':
+                continue
+            elif cmd == '.INCLUDE':
+                name = parts[1]
+                if name not in self.included:
+                    self.included.add(name)
+                    with open(name) as f:
+                        self.feed(f, bytecode, labels, fixups)
+            elif cmd in self.macros:
+                self.expand(cmd, parts[1:], bytecode, labels, fixups)
+            elif line.startswith(':'):
+                label = line.upper()
+                labels[label] = len(bytecode)
+                for pos, _ in fixups.pop(label, ()):
+                    bytecode[pos] = labels[label]
+            else:
+                self.emit(cmd, parts, bytecode, labels, fixups)
+
+    def expand(self, name, args, bytecode, labels, fixups):
+        if name in self.expanding:
+            raise SyntaxError('recursive macro ' + name)
+
+        params, body = self.macros[name]
+        subst = {}
+        for i in range(len(params)):
+            subst['$' + params[i]] = args[i] if i < len(args) else '0'
+
+        if subst:
+            body = (' '.join([subst.get(t, t) for t in line.split()]) for line in body)
+
+        self.expanding.append(name)
+        try:
+            self.feed(body, bytecode, labels, fixups)
+        finally:
+            self.expanding.pop()
+
+    def emit(self, cmd, parts, bytecode, labels, fixups):
+        op_code, length = self.ops[cmd]
+        bytecode.append(op_code)
+
+        if length == 2:
+            if len(parts) < 2:
+                bytecode.append(0)
+                return
+
+            arg = parts[1]
+            label = arg.upper()
+            if label in labels:
+                bytecode.append(labels[label])
+            elif arg.startswith(':'):
+                fixups.setdefault(label, []).append((len(bytecode), arg))
+                bytecode.append(0)
+            else:
+                bytecode.append(self.atom(arg))
     
 CLOSED, RUNNING, WAITING, READY = 1, 2, 3, 4
 
@@ -96,6 +146,9 @@ class VirtualMachine:
         self.state = CLOSED
         self.ended = 0
         self.ports_count = 0
+        self.acct = None
+        self.sizes = {}
+        self.held = []
         
     def load_prog(self, bytecode):
         self.program = bytecode
@@ -103,9 +156,41 @@ class VirtualMachine:
         self.stack = []
         self.env = {'exitcode': 0}
         self.ports_count = 0
+        self.sizes = {}
+        self.held = []
 
     def save_ctx(self, sc, env, pc):
         self.stack, self.env, self.pc = sc, env, pc
+
+    def hold(self, val):
+        if not self.acct or type(val) is int:
+            return True
+        if self.held:
+            self.prune()
+        size = msize(val)
+        if not self.acct.charge(size):
+            return False
+        self.held.append((val, size))
+        return True
+
+    def drop(self, val):
+        held = self.held
+        for i in range(len(held)):
+            if held[i][0] is val:
+                self.acct.uncharge(held[i][1])
+                del held[i]
+                return
+
+    def prune(self):
+        kept = []
+        for entry in self.held:
+            for val in self.stack:
+                if val is entry[0]:
+                    kept.append(entry)
+                    break
+            else:
+                self.acct.uncharge(entry[1])
+        self.held = kept
     
     def make_step(self, quantum=3):
         if self.ended == 1:
@@ -147,6 +232,15 @@ class VirtualMachine:
                 pc += 2
             elif op == STORE:
                 value = stack.pop()
+                if self.held:
+                    self.drop(value)
+                if self.acct:
+                    size = msize(value)
+                    if not self.acct.charge(size - self.sizes.get(arg, 0)):
+                        self.state = CLOSED
+                        self.ended = 1
+                        return None
+                    self.sizes[arg] = size
                 env[arg] = value
                 pc += 2
             elif op == PUSH:
@@ -197,7 +291,9 @@ class VirtualMachine:
                 stack.pop()
                 pc += 1
             elif op == POP:
-                stack.pop()
+                val = stack.pop()
+                if self.held:
+                    self.drop(val)
                 pc += 1
             elif op == JZ:
                 if stack.pop() == 0:
@@ -222,8 +318,11 @@ class VirtualMachine:
                 remote_port = stack.pop()
                 local_port = stack.pop()
                 val = stack.pop()
+                if self.held:
+                    self.drop(val)
                 
                 status, target_pid = self.ipc.send(self.pid, (remote_port, local_port, val))
+                env['status'] = status
                 
                 pc += 1
                 
@@ -243,6 +342,10 @@ class VirtualMachine:
                     stack.append(port_id)
                     break
                 elif status == PORT_SUCCESS:
+                    if not self.hold(msg):
+                        self.state = CLOSED
+                        self.ended = 1
+                        return None
                     stack.append(msg)
                 else:
                     stack.append(0)
@@ -259,9 +362,15 @@ class VirtualMachine:
                 res = []
                 for i in range(count):
                     val = stack.pop()
+                    if self.held:
+                        self.drop(val)
                     res.append(val)
                     
                 res = res[::-1]
+                if not self.hold(res):
+                    self.state = CLOSED
+                    self.ended = 1
+                    return None
                 stack.append(res)
                 pc += 1
             elif op == DICT:
@@ -275,6 +384,8 @@ class VirtualMachine:
                 raw_data = []
                 for _ in range(count):
                     val = stack.pop()
+                    if self.held:
+                        self.drop(val)
                     raw_data.append(val)
                 
                 res = {}
@@ -286,6 +397,11 @@ class VirtualMachine:
                     val = raw_data[i - 1]
                     res[key] = val
                     i -= 2
+
+                if not self.hold(res):
+                    self.state = CLOSED
+                    self.ended = 1
+                    return None
                         
                 stack.append(res)
                 pc += 1
@@ -308,6 +424,16 @@ class VirtualMachine:
                     self.ended = 1
                     return None
              
+                if self.acct and (type(obj) is list or type(obj) is dict):
+                    size = SLOT + msize(stack[-1])
+                    if type(obj) is dict:
+                        size += SLOT + msize(stack[-2])
+                    if not self.acct.charge(size):
+                        self.state = CLOSED
+                        self.ended = 1
+                        return None
+                    self.sizes[arg] = self.sizes.get(arg, 0) + size
+
                 if type(obj) is dict:
                     key = stack.pop()
                     val = stack.pop()
@@ -1,9 +1,15 @@
 from ipc import *
 from proc import *
+from mem import *
 import gc
 
 _msb_table = (-1, 0, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 3, 3)
 
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
 class PrioSched:
     def __init__(self, max_prio=16):
         self.max_prio = max_prio
@@ -14,7 +20,7 @@ class PrioSched:
         self.task_slices = {}
         self.default_slice = 2
 
-    def create_proc(self, pid, prio):
+    def create_proc(self, pid, prio, period=0, budget=0):
         self.task_slices[pid] = self.default_slice
         
         while prio >= len(self.active_queues):
@@ -23,6 +29,14 @@ class PrioSched:
         
         self.active_queues[prio].append(pid)
         self.active_mask |= (1 << prio)
+        return True
+
+    def remove_proc(self, pid):
+        if pid in self.task_slices:
+            del self.task_slices[pid]
+
+        for prio in range(len(self.active_queues)):
+            self.dequeue(pid, prio)
         
     def tick(self, pid):
         if pid not in self.task_slices:
@@ -47,10 +61,39 @@ class PrioSched:
             res += 4
         return res + _msb_table[m & 0x0F]
 
+    def sleep(self, pid):
+        # waiting processes stay queued, the kernel skips them
+        pass
+
+    def handoff(self, pid):
+        return True
+
+    def dequeue(self, pid, prio):
+        if prio >= len(self.active_queues):
+            return
+        queue = self.active_queues[prio]
+        if pid in queue:
+            queue.remove(pid)
+            if not queue:
+                self.active_mask &= ~(1 << prio)
+        queue = self.expired_queues[prio]
+        if pid in queue:
+            queue.remove(pid)
+            if not queue:
+                self.expired_mask &= ~(1 << prio)
+
     def wake_up(self, pid, prio):
+        self.dequeue(pid, prio)
         self.active_queues[prio].insert(0, pid)
         self.active_mask |= (1 << prio)
 
+    def requeue(self, pid, old_prio, new_prio):
+        self.dequeue(pid, old_prio)
+        while new_prio >= len(self.active_queues):
+            self.active_queues.append([])
+            self.expired_queues.append([])
+        self.wake_up(pid, new_prio)
+
     def get_next_proc(self):
         if self.active_mask == 0:
             if self.expired_mask == 0: 
@@ -70,40 +113,195 @@ class PrioSched:
 
         return pid
 
+class EDFSched:
+    def __init__(self):
+        self.now = 0
+        self.tasks = {}
+        self.background = []
+        self.sleeping = set()
+        self.util_num = 0
+        self.util_den = 1
+        self.misses = 0
+
+    def create_proc(self, pid, prio, period=0, budget=0):
+        if not period:
+            self.background.append(pid)
+            return True
+
+        if budget <= 0 or budget > period:
+            return False
+        den = self.util_den * period // _gcd(self.util_den, period)
+        num = self.util_num * (den // self.util_den) + budget * (den // period)
+        if num > den:
+            return False
+
+        self.util_num, self.util_den = num, den
+        self.tasks[pid] = {
+            'period': period,
+            'budget': budget,
+            'left': budget,
+            'deadline': self.now + 1 + period,
+            'misses': 0,
+        }
+        return True
+
+    def remove_proc(self, pid):
+        task = self.tasks.pop(pid, None)
+        if task:
+            self.util_num -= task['budget'] * (self.util_den // task['period'])
+            if not self.tasks:
+                self.util_num, self.util_den = 0, 1
+        if pid in self.background:
+            self.background.remove(pid)
+        self.sleeping.discard(pid)
+
+    def tick(self, pid):
+        task = self.tasks.get(pid)
+        return task is None or task['left'] <= 0
+
+    def sleep(self, pid):
+        self.sleeping.add(pid)
+
+    def wake_up(self, pid, prio):
+        self.sleeping.discard(pid)
+
+    def requeue(self, pid, old_prio, new_prio):
+        # deadlines, not priorities, order EDF tasks
+        pass
+
+    def handoff(self, pid):
+        task = self.tasks.get(pid)
+        if task is None or task['left'] <= 0 or pid in self.sleeping:
+            return False
+        task['left'] -= 1
+        return True
+
+    def get_next_proc(self):
+        self.now += 1
+        now = self.now
+        best = None
+        best_deadline = 0
+
+        for pid in self.tasks:
+            task = self.tasks[pid]
+            if now >= task['deadline']:
+                if task['left'] > 0 and pid not in self.sleeping:
+                    task['misses'] += 1
+                    self.misses += 1
+                periods = (now - task['deadline']) // task['period'] + 1
+                task['deadline'] += periods * task['period']
+                task['left'] = task['budget']
+
+            if task['left'] > 0 and pid not in self.sleeping:
+                if best is None or task['deadline'] < best_deadline:
+                    best = pid
+                    best_deadline = task['deadline']
+
+        if best is not None:
+            self.tasks[best]['left'] -= 1
+            return best
+
+        queue = self.background
+        for _ in range(len(queue)):
+            pid = queue.pop(0)
+            queue.append(pid)
+            if pid not in self.sleeping:
+                return pid
+
+        return None
+
 class Kernel:
     def __init__(self, scheduler, ipc):
         self.sched = scheduler
         self.asm = Assembler()
         self.ipc = ipc
         self.ipc.sched = self.sched
-        self.ipc.getprio = lambda pid: self.procs[pid]['prio']
+        self.ipc.wake = self.wake_up
+        self.ipc.donate = self.donate
         self.procs = {}
+        self.pollers = [self.ipc.flush]
+        self.default_quota = 8192
+
+    def spawn(self, pid, prio, code, period=0, budget=0, quota=None):
+        if quota is None:
+            quota = self.default_quota
+        acct = MemAccount(quota)
+        if not acct.charge(STACK_COST):
+            return False
 
-    def spawn(self, pid, prio, code):
         binary = self.asm.assemble(code)
         vm = VirtualMachine(self.ipc, pid)
         vm.load_prog(binary)
+        vm.acct = acct
         
         gc.collect()
-        
+
+        if not self.sched.create_proc(pid, prio, period, budget):
+            return False
+
+        self.ipc.accounts[pid] = acct
         self.procs[pid] = {
             'state': READY,
             'prio': prio,
+            'eprio': prio,
+            'donors': [],
             'vm': vm,
             'closed_count': 0,
         }
-        
-        self.sched.create_proc(pid, prio)
-        
+        return True
+
+    def wake_up(self, pid):
+        p_info = self.procs.get(pid)
+        if not p_info:
+            return
+        if p_info['state'] == WAITING:
+            p_info['state'] = READY
+        self.sched.wake_up(pid, p_info['eprio'])
+
+    def reprio(self, pid):
+        p_info = self.procs[pid]
+        new_prio = p_info['prio']
+        for donor in p_info['donors']:
+            if donor[1] > new_prio:
+                new_prio = donor[1]
+
+        old_prio = p_info['eprio']
+        if new_prio != old_prio:
+            p_info['eprio'] = new_prio
+            self.sched.requeue(pid, old_prio, new_prio)
+
+    def donate(self, src, dst, port_id, reply_port):
+        if src == dst:
+            return
+        s_info = self.procs.get(src)
+        d_info = self.procs.get(dst)
+        if not s_info or not d_info:
+            return
+
+        donors = s_info['donors']
+        for i in range(len(donors)):
+            if donors[i][0] == port_id:
+                del donors[i]
+                self.reprio(src)
+                break
+
+        if reply_port and s_info['eprio'] > d_info['prio']:
+            d_info['donors'].append((reply_port, s_info['eprio'], src))
+            self.reprio(dst)
+
     def exit_proc(self, pid):
         self.ipc.cleanup_process(pid)
+        self.ipc.accounts.pop(pid, None)
 
         del self.procs[pid]
-        del self.sched.task_slices[pid]
-        
-        for q_list in self.sched.active_queues + self.sched.expired_queues:
-            if pid in q_list:
-                q_list.remove(pid)
+        self.sched.remove_proc(pid)
+
+        for other in self.procs:
+            donors = self.procs[other]['donors']
+            kept = [d for d in donors if d[2] != pid]
+            if len(kept) != len(donors):
+                self.procs[other]['donors'] = kept
+                self.reprio(other)
 
     def run_task(self, vm, big_f, p_info,
                  system_pids, pid):
@@ -121,8 +319,11 @@ class Kernel:
                 
             if vm.state == WAITING:
                 p_info['state'] = WAITING
+                self.sched.sleep(pid)
             elif vm.state == CLOSED:
                 self.exit_proc(pid)
+            elif p_info['state'] == WAITING:
+                p_info['state'] = READY
             return r
         except:
             if p_info['closed_count'] == 3 and (system_pids and not pid in system_pids):
@@ -134,14 +335,17 @@ class Kernel:
 
     def kernel_loop(self, system_pids=None, big_f=False):
         while self.procs:
+            for poll in self.pollers:
+                poll()
+
             try:
                 pid = self.sched.get_next_proc()
             except:
                 continue
 
-            p_info = self.procs[pid]
+            p_info = self.procs.get(pid)
             
-            if p_info['state'] == WAITING:
+            if not p_info or p_info['state'] == WAITING:
                 continue
         
             p_info['state'] = RUNNING
@@ -159,6 +363,9 @@ class Kernel:
 
                     if tp_info['vm'].ended == 1:
                         break
+
+                    if not self.sched.handoff(current_target):
+                        break
                     
                     next_target = self.run_task(tp_info['vm'], big_f, tp_info,
                                                 system_pids, current_target)